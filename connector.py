@@ -1,22 +1,42 @@
 #!/usr/bin/env python3
 
-from PyQt5.QtCore import QAbstractTableModel, QVariant, Qt, QModelIndex
+from PyQt5.QtCore import (QAbstractTableModel, Qt, QModelIndex,
+                          QPersistentModelIndex, QObject, QThread, QTimer,
+                          pyqtSignal, pyqtSlot)
+from PyQt5.QtGui import QBrush, QFontMetrics
 from PyQt5.QtWidgets import (QWidget, QPushButton, QPlainTextEdit, QLineEdit,
                              QMessageBox, QApplication, QDesktopWidget,
-                             QTableView, QComboBox, QGridLayout, QLabel)
-
-import psycopg2
+                             QTableView, QComboBox, QGridLayout, QLabel,
+                             QStyledItemDelegate, QStyleOptionViewItem)
 
+from collections import OrderedDict, deque
+import bisect
 import logging
+import pickle
 import sqlite3
 import sys
 import os
+import re
+import tempfile
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Queries that may run through DECLARE ... CURSOR FOR; PostgreSQL still
+# rejects some of them (SELECT ... INTO, data-modifying WITH), which then
+# run on a client-side cursor instead
+STREAMABLE_QUERY = re.compile(r'^\s*(select|with|values|table)\b', re.IGNORECASE)
+# Queries whose results may be served from the result cache
+READ_ONLY_QUERY = re.compile(r'^\s*(select|with|values|table|explain)\b', re.IGNORECASE)
+# Keywords of statements that write, e.g. WITH ... INSERT or SELECT ... INTO
+DATA_MODIFYING = re.compile(r'\b(insert|update|delete|merge|into)\b', re.IGNORECASE)
+RESULT_CACHE_SIZE = 64
+
 
 class Connector:
+    # Rows per fetch; kept constant so drivers can reuse their row buffers
+    BLOCK_SIZE = 200
+
     def __init__(self, connstring, db_type):
         """
         Args:
@@ -26,27 +46,127 @@ class Connector:
         self.connstring = connstring
         self.connector = db_type
         self.connect = None
+        self.cursor = None
+        self.exhausted = True
+        self.serverSide = db_type is not sqlite3
+        # Queries run in a worker thread while further rows are
+        # fetched from the GUI thread, never both at once.
+        self.connectArgs = {} if self.serverSide else {'check_same_thread': False}
 
     def execute(self, query):
-        self.connect = self.connector.connect(self.connstring)
-        self.cursor = self.connect.cursor()
-        self.cursor.execute(query)
-        self.connect.commit()
+        self.release()
+        if not self.connect or getattr(self.connect, 'closed', False):
+            self.close()
+            self.connect = self.connector.connect(self.connstring, **self.connectArgs)
+        try:
+            if self.serverSide and STREAMABLE_QUERY.match(query):
+                try:
+                    self.open_cursor(query, 'sqlconn_%d' % id(self))
+                except (self.connector.ProgrammingError,
+                        self.connector.NotSupportedError):
+                    # DECLARE refused the query before running it
+                    self.connect.rollback()
+                    self.open_cursor(query)
+            else:
+                self.open_cursor(query)
+        except (self.connector.OperationalError, self.connector.InterfaceError):
+            # The connection may have died, then the next query reconnects
+            self.cursor = None
+            try:
+                self.connect.rollback()
+            except self.connector.Error:
+                pass
+            if not self.ping():
+                self.close()
+            raise
+        except self.connector.Error:
+            # Leave the connection usable for the next query
+            self.cursor = None
+            self.connect.rollback()
+            raise
+        self.exhausted = False
+
+    def open_cursor(self, query, name=None):
+        if name:
+            # Named cursor keeps the result set on the server and
+            # fetchmany() pulls it over the wire block by block.
+            # It lives inside the transaction, so no commit here.
+            cursor = self.connect.cursor(name=name)
+            cursor.itersize = Connector.BLOCK_SIZE
+            cursor.arraysize = Connector.BLOCK_SIZE
+            cursor.execute(query)
+        else:
+            cursor = self.connect.cursor()
+            cursor.arraysize = Connector.BLOCK_SIZE
+            cursor.execute(query)
+            self.connect.commit()
+        self.cursor = cursor
+
+    def ping(self):
+        """Checks the connection with a round trip, outside of any query."""
+        if not self.connect or getattr(self.connect, 'closed', False):
+            return False
+        try:
+            cursor = self.connect.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            self.connect.rollback()
+        except self.connector.Error:
+            return False
+        return True
+
+    def release(self):
+        """Closes the cursor of the previous query and ends its transaction."""
+        if self.cursor:
+            try:
+                self.cursor.close()
+                self.connect.commit()
+            except self.connector.Error:
+                pass
+            self.cursor = None
+        self.exhausted = True
 
     def get_headers(self):
         if self.cursor.description:
             return [col[0] for col in self.cursor.description]
 
     def get_data(self):
-        return self.cursor.fetchmany(size=1000)
-
-    def __del__(self):
+        rows = self.cursor.fetchmany()
+        if len(rows) < self.cursor.arraysize:
+            self.exhausted = True
+        return rows
+
+    def cancel(self):
+        """Interrupts the query running in another thread, if any."""
+        connect = self.connect
+        if connect is None:
+            return
+        if self.serverSide:
+            connect.cancel()
+        else:
+            connect.interrupt()
+
+    @classmethod
+    def set_block_size(cls, size):
+        """Sets the number of rows fetched per block by subsequent queries."""
+        cls.BLOCK_SIZE = size
+
+    def close(self):
+        self.release()
         if self.connect:
             self.connect.close()
+            self.connect = None
+
+    def __del__(self):
+        self.close()
 
 
 class ResultTableModel(QAbstractTableModel):
-    ROWS_COUNT = 25
+    MULTIPLE_ROLES = Qt.UserRole + 1
+    # Blocks of rows kept in memory, older ones are spilled to disk
+    WINDOW_BLOCKS = 4
+    # The same for every cell, so flags() never reaches the base class
+    FLAGS = Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemNeverHasChildren
 
     def __init__(self, data, headers, datasource=None, parent=None):
         """
@@ -55,55 +175,217 @@ class ResultTableModel(QAbstractTableModel):
             headers: a list of strings
         """
         super().__init__(parent)
-        self.data = data
-        self.headers = headers
-        self.rowsLoaded = ResultTableModel.ROWS_COUNT
+        # Returned as is by headerData() on every header repaint
+        self.headers = tuple(str(header) for header in headers)
+        self.columnsCount = len(headers)
+        self.rowsCount = 0
+        # (first row, display strings of its cells row after row) per block
+        self.blocks = deque()
+        self.spillFile = None
+        self.spilledStarts = []
+        self.spilledPositions = []
+        self.loaded = (0, [])
         self.datasource = datasource
+        # (rows, display blocks) read ahead while the view is idle
+        self.pending = None
+        self.prefetchTimer = QTimer(self)
+        self.prefetchTimer.setSingleShot(True)
+        self.prefetchTimer.timeout.connect(self.prefetch)
+        self.appendRows(data)
+
+    def stringify(self, rows):
+        """Splits rows into blocks of display strings, one pass per block."""
+        size = Connector.BLOCK_SIZE
+        return [['' if value is None else str(value)
+                 for row in rows[i:i + size] for value in row]
+                for i in range(0, len(rows), size)]
+
+    def appendRows(self, rows, blocks=None):
+        if blocks is None:
+            blocks = self.stringify(rows)
+        for cells in blocks:
+            self.blocks.append((self.rowsCount, cells))
+            self.rowsCount += len(cells) // self.columnsCount
+        while len(self.blocks) > ResultTableModel.WINDOW_BLOCKS:
+            self.spill(*self.blocks.popleft())
+
+    def spill(self, start, cells):
+        if self.spillFile is None:
+            self.spillFile = tempfile.TemporaryFile()
+        self.spillFile.seek(0, os.SEEK_END)
+        self.spilledStarts.append(start)
+        self.spilledPositions.append(self.spillFile.tell())
+        pickle.dump(cells, self.spillFile, pickle.HIGHEST_PROTOCOL)
+
+    def cell(self, row, column):
+        offset = row * self.columnsCount + column
+        for start, cells in reversed(self.blocks):
+            if row >= start:
+                return cells[offset - start * self.columnsCount]
+        start, cells = self.loaded
+        if not start <= row < start + len(cells) // self.columnsCount:
+            i = bisect.bisect_right(self.spilledStarts, row) - 1
+            self.spillFile.seek(self.spilledPositions[i])
+            start, cells = self.loaded = (self.spilledStarts[i],
+                                          pickle.load(self.spillFile))
+        return cells[offset - start * self.columnsCount]
 
     def rowCount(self, parent):
-        if len(self.data) <= self.rowsLoaded:
-            return len(self.data)
-        return self.rowsLoaded
+        return self.rowsCount
 
     def columnCount(self, parent):
-        return len(self.headers)
+        return self.columnsCount
 
     def canFetchMore(self, index=QModelIndex()):
-        if len(self.data) > self.rowsLoaded:
+        if self.pending is not None:
             return True
-        if self.datasource:
-            self.addRecords()
-        return False
+        return self.datasource is not None and not self.datasource.exhausted
+
+    def fetchBlock(self):
+        try:
+            return self.datasource.get_data()
+        except self.datasource.connector.Error as e:
+            # Runs inside Qt virtuals and timers, where it must not escape
+            logging.error(e)
+            self.datasource.exhausted = True
+            return []
 
-    def addRecords(self):
-        self.beginResetModel()
-        self.data += self.datasource.get_data()
-        self.endResetModel()
+    def prefetch(self):
+        if self.pending is None and self.canFetchMore():
+            rows = self.fetchBlock()
+            self.pending = (rows, self.stringify(rows))
 
     def fetchMore(self, index=QModelIndex()):
-        reminder = len(self.data) - self.rowsLoaded
-        itemsToFetch = min(reminder, ResultTableModel.ROWS_COUNT)
-        self.beginInsertRows(QModelIndex(), self.rowsLoaded, self.rowsLoaded + itemsToFetch - 1)
-        self.rowsLoaded += itemsToFetch
+        if self.pending is not None:
+            (rows, blocks), self.pending = self.pending, None
+        else:
+            rows, blocks = self.fetchBlock(), None
+        if not rows:
+            return
+        start = self.rowCount(QModelIndex())
+        self.beginInsertRows(QModelIndex(), start, start + len(rows) - 1)
+        self.appendRows(rows, blocks)
         self.endInsertRows()
+        self.prefetchTimer.start(0)
+
+    def flags(self, index):
+        return ResultTableModel.FLAGS if index.isValid() else Qt.NoItemFlags
 
     def data(self, index, role):
         if not index.isValid():
-            return QVariant()
+            return None
+        elif role == ResultTableModel.MULTIPLE_ROLES:
+            return {
+                Qt.DisplayRole: self.cell(index.row(), index.column()),
+                Qt.FontRole: None,
+                Qt.BackgroundRole: None}
         elif role != Qt.DisplayRole:
-            return QVariant()
-        return QVariant(self.data[index.row()][index.column()])
+            return None
+        return self.cell(index.row(), index.column())
 
     def headerData(self, col, orientation, role):
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
-            return QVariant(self.headers[col])
-        return QVariant()
+            return self.headers[col]
+        return None
+
+
+class SpeedUpDelegate(QStyledItemDelegate):
+    """
+    Asks the model for all paint roles in one data() call and keeps them
+    in an LRU cache instead of querying every role on each repaint.
+    """
+    CACHE_SIZE = 4000
+    PAINT_ROLES = {Qt.DisplayRole, Qt.FontRole, Qt.BackgroundRole}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.cache = OrderedDict()
+
+    def clear(self):
+        self.cache.clear()
+
+    def watch(self, model):
+        """Keeps the cache in step with the change signals of the model."""
+        self.clear()
+        model.dataChanged.connect(self.on_data_changed)
+        model.rowsRemoved.connect(self.clear)
+        model.layoutChanged.connect(self.clear)
+        model.modelReset.connect(self.clear)
+
+    def on_data_changed(self, topLeft, bottomRight, roles=()):
+        if roles and not SpeedUpDelegate.PAINT_ROLES.intersection(roles):
+            return
+        rows = range(topLeft.row(), bottomRight.row() + 1)
+        cols = range(topLeft.column(), bottomRight.column() + 1)
+        for key in [key for key in self.cache
+                    if key.row() in rows and key.column() in cols]:
+            del self.cache[key]
+
+    def roles(self, index):
+        key = QPersistentModelIndex(index)
+        roles = self.cache.get(key)
+        if roles is None:
+            roles = index.data(ResultTableModel.MULTIPLE_ROLES)
+            self.cache[key] = roles
+            if len(self.cache) > SpeedUpDelegate.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return roles
+
+    def initStyleOption(self, option, index):
+        roles = self.roles(index)
+        option.index = index
+        option.displayAlignment = Qt.AlignLeft | Qt.AlignVCenter
+        font = roles[Qt.FontRole]
+        if font is not None:
+            option.font = font
+            option.fontMetrics = QFontMetrics(font)
+        background = roles[Qt.BackgroundRole]
+        if background is not None:
+            option.backgroundBrush = QBrush(background)
+        text = roles[Qt.DisplayRole]
+        if text:
+            option.features |= QStyleOptionViewItem.HasDisplay
+            option.text = text
+
+
+class QueryWorker(QObject):
+    finished = pyqtSignal(list, list)
+    error = pyqtSignal(object)
+
+    def __init__(self, connector, query):
+        """
+        Args:
+            connector: a Connector
+            query: a string
+        """
+        super().__init__()
+        self.connector = connector
+        self.query = query
+
+    @pyqtSlot()
+    def run(self):
+        db = self.connector.connector
+        try:
+            self.connector.execute(self.query)
+            data = self.connector.get_data()
+            headers = self.connector.get_headers()
+        except db.Error as e:
+            self.error.emit(e)
+        else:
+            self.finished.emit(data, headers or [])
 
 
 class MainWidget(QWidget):
     def __init__(self):
         super().__init__()
 
+        # One live connector per (dbType, connString), reused across queries
+        self.connCache = {}
+        # (headers, rows) of fully fetched read-only results in LRU order
+        self.resultCache = OrderedDict()
+        self.resultCacheKey = None
         self.initUI()
 
     def initUI(self):
@@ -127,6 +409,8 @@ class MainWidget(QWidget):
         self.queryField = QPlainTextEdit(self)
 
         self.resultTable = QTableView(self)
+        self.resultDelegate = SpeedUpDelegate(self.resultTable)
+        self.resultTable.setItemDelegate(self.resultDelegate)
 
         self.launchButton = QPushButton('Launch', self)
 
@@ -166,23 +450,96 @@ class MainWidget(QWidget):
                 self.show_message('There is no such database file.')
                 return
 
-        connector = get_connector(dbType, connString)
-        try:
-            connector.execute(query)
-            data, headers = connector.get_data(), connector.get_headers()
-
-            if not headers:
-                self.show_message('There is no result for your query.')
+        key = (dbType, connString)
+        if READ_ONLY_QUERY.match(query) and not DATA_MODIFYING.search(query):
+            self.resultCacheKey = key + (query.strip(),)
+            result = self.resultCache.get(self.resultCacheKey)
+            if result is not None:
+                self.resultCache.move_to_end(self.resultCacheKey)
+                headers, data = result
+                self.show_result(list(data), list(headers))
                 return
-
-            model = ResultTableModel(data, headers, connector)
-            self.resultTable.setModel(model)
-        except (psycopg2.ProgrammingError, sqlite3.OperationalError) as e:
-            self.show_message(str(e)[:1].capitalize() + str(e)[1:], 'Error!')
-            logging.error(e)
-        except psycopg2.OperationalError as e:
-            self.show_message(str(e)[:1].capitalize() + str(e)[1:], 'Error!')
-            logging.error(e)
+        else:
+            # Any other statement may change what cached queries return
+            self.resultCacheKey = None
+            self.resultCache.clear()
+
+        connector = self.connCache.get(key)
+        if connector is None:
+            try:
+                connector = get_connector(dbType, connString)
+            except ImportError as e:
+                self.show_message('psycopg2 is not installed.', 'Error!')
+                logging.error(e)
+                return
+            self.connCache[key] = connector
+
+        model = self.resultTable.model()
+        if model is not None and model.datasource is connector:
+            # Running another query releases the cursor this model reads
+            # from; a result cut short there must not look complete
+            complete = connector.exhausted
+            model.datasource = None
+            if not complete:
+                self.resultDelegate.clear()
+                self.resultTable.setModel(None)
+
+        self.queryThread = QThread(self)
+        self.queryWorker = QueryWorker(connector, query)
+        self.queryWorker.moveToThread(self.queryThread)
+        self.queryThread.started.connect(self.queryWorker.run)
+        self.queryWorker.finished.connect(self.on_query_done)
+        self.queryWorker.error.connect(self.on_query_error)
+        self.queryWorker.finished.connect(self.queryThread.quit)
+        self.queryWorker.error.connect(self.queryThread.quit)
+        self.queryThread.finished.connect(self.queryWorker.deleteLater)
+        self.queryThread.finished.connect(self.queryThread.deleteLater)
+
+        self.launchButton.setEnabled(False)
+        self.queryThread.start()
+
+    def on_query_done(self, data, headers):
+        self.launchButton.setEnabled(True)
+
+        if not headers:
+            # A statement without a result set may have written data
+            self.resultCache.clear()
+            self.show_message('There is no result for your query.')
+            return
+
+        connector = self.queryWorker.connector
+        if self.resultCacheKey and connector.exhausted:
+            self.resultCache[self.resultCacheKey] = (tuple(headers), tuple(data))
+            if len(self.resultCache) > RESULT_CACHE_SIZE:
+                self.resultCache.popitem(last=False)
+
+        self.show_result(data, headers, connector)
+
+    def show_result(self, data, headers, datasource=None):
+        model = ResultTableModel(data, headers, datasource)
+        self.resultDelegate.watch(model)
+        self.resultTable.setModel(model)
+
+    def on_query_error(self, e):
+        self.launchButton.setEnabled(True)
+        message = str(e)
+        self.show_message(
+            message[:1].upper() + message[1:] if message else 'Unknown error',
+            'Error!')
+        logging.error(e)
+
+    def closeEvent(self, event):
+        if not self.launchButton.isEnabled():
+            # Nobody is left to show the outcome of the cancelled query
+            self.queryWorker.finished.disconnect(self.on_query_done)
+            self.queryWorker.error.disconnect(self.on_query_error)
+            self.queryWorker.connector.cancel()
+            # The queued quit from the worker would need this blocked thread
+            self.queryThread.quit()
+            self.queryThread.wait()
+        for connector in self.connCache.values():
+            connector.close()
+        super().closeEvent(event)
 
     def center(self):
         frameGeometry = self.frameGeometry()
@@ -192,10 +549,13 @@ class MainWidget(QWidget):
 
 
 def get_connector(dbType, connstring):
-    dbTypes = {
-        'sqlite3': sqlite3,
-        'postgres': psycopg2}
-    return Connector(connstring, dbTypes[dbType])
+    if dbType == 'postgres':
+        # psycopg2 is only imported once a postgres connection is requested
+        import psycopg2.extras
+        # Wait for libpq in select() so a running query can be interrupted
+        psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
+        return Connector(connstring, psycopg2)
+    return Connector(connstring, sqlite3)
 
 
 def main():